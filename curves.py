@@ -10,6 +10,7 @@ Currently, only single curves can be processed.
 """
 
 
+import io
 import numpy as np
 import pyperclip
 
@@ -19,8 +20,7 @@ def paste():
     content = content.split('\n')
     head = content[:24]
     body = content[24:]
-    data = [line[:-1].split('\t') for line in body[:-1]]
-    data = np.asfarray(data,float)
+    data = np.genfromtxt(io.StringIO('\n'.join(body[:-1])), delimiter='\t', dtype=np.float64, ndmin=2)
     freq = data[:,0]
     cmplx = data[:,1]+1j*data[:,2]
     return head, data, freq, cmplx
@@ -29,9 +29,9 @@ def copy(head, data):
     """Copy a single S-parameter curve to the clipboard."""
     #data[:,1] = np.real(cmplx)
     #data[:,2] = np.imag(cmplx)
-    body = np.asarray(data, str)
-    body = [ '\t'.join(x)+'\r' for x in body]
-    pyperclip.copy('\n'.join(head+body))
+    body = io.StringIO()
+    np.savetxt(body, data, fmt='%s', delimiter='\t', newline='\r\n')
+    pyperclip.copy('\n'.join(head+[body.getvalue().rstrip('\n')]))
 
 def new_label(head, label):
     """Change the label of an S-parameter curve."""
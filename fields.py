@@ -24,6 +24,11 @@ import h5py
 import numpy
 import re
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+_FIELD_TYPE_RE = re.compile(rb'[HE]-Field')
+_FREQ_RE = re.compile(rb'\(f=[-+]?\d+\.?\d*\)')
+_CST_DLL_CACHE = {}  # CST_version -> loaded ResultReader dll, released by shutdown()
 
 def _get_CST_InstallPath(CST_version):
     wr_handle = winreg.ConnectRegistry(None, winreg.HKEY_LOCAL_MACHINE)
@@ -48,6 +53,8 @@ def _get_CST_result_reader_path(CST_version, verbose=False):
 
 
 def _load_CST_result_reader_dll(CST_version, verbose=False):
+    if CST_version in _CST_DLL_CACHE:
+        return _CST_DLL_CACHE[CST_version]
     dll_path = _get_CST_result_reader_path(CST_version)
     if verbose: print("Trying to load dll from", dll_path)
     if not os.path.exists(dll_path):
@@ -56,9 +63,19 @@ def _load_CST_result_reader_dll(CST_version, verbose=False):
     iVersion = ctypes.c_int()
     cstlib.CST_GetDLLVersion(ctypes.byref(iVersion))
     if verbose: print("DLL version:", iVersion)
+    _CST_DLL_CACHE[CST_version] = cstlib
     return cstlib
 
 
+def shutdown():
+    """
+    Free all loaded ResultReader dlls
+    """
+    for cstlib in _CST_DLL_CACHE.values():
+        _ctypes.FreeLibrary(cstlib._handle)
+    _CST_DLL_CACHE.clear()
+
+
 def _get_item_names(pHandle, cstlib, search_string):
     ERROR_CODE_MEMORY = 8
     buf_size = 10000
@@ -80,9 +97,7 @@ def _get_item_names(pHandle, cstlib, search_string):
 
 
 def _check_array(Matrix, dExpectedSum, sName):
-    dSum = 0
-    for x in Matrix:
-        dSum += x
+    dSum = float(numpy.ctypeslib.as_array(Matrix).sum(dtype=numpy.float64))
     bOK = abs(dSum/dExpectedSum-1)<0.001
     if not bOK:
         print("Error: Something might be wrong with reading ", sName)
@@ -92,6 +107,8 @@ def _check_array(Matrix, dExpectedSum, sName):
 def load_fields(CST_version, sProjectPath, sProjectName, freqScale, verbose=False):
     """
     Load all 3D Fields of a project
+
+    The ResultReader dll stays loaded for further projects, call shutdown() to free it when done.
     """
     # Load DLL, get DLL version
     cstlib = _load_CST_result_reader_dll(CST_version)
@@ -125,16 +142,17 @@ def load_fields(CST_version, sProjectPath, sProjectName, freqScale, verbose=Fals
     xyzlines = t_xyzlines_array()
     ret = cstlib.CST_GetHexMesh(ctypes.byref(pHandle), ctypes.byref(xyzlines))
     # Ergebnis: mesh-lines
-    xlines = numpy.array(xyzlines[0:Nxyz[0]])
-    ylines = numpy.array(xyzlines[Nxyz[0]:Nxyz[0]+Nxyz[1]])
-    zlines = numpy.array(xyzlines[Nxyz[0]+Nxyz[1]:Nxyz[0]+Nxyz[1]+Nxyz[2]])
+    xyzlines = numpy.ctypeslib.as_array(xyzlines)  # view on the ctypes buffer, no copy
+    xlines = xyzlines[0:Nxyz[0]]
+    ylines = xyzlines[Nxyz[0]:Nxyz[0]+Nxyz[1]]
+    zlines = xyzlines[Nxyz[0]+Nxyz[1]:Nxyz[0]+Nxyz[1]+Nxyz[2]]
     #############
     # Read results
     n = len(efield_names + hfield_names)
-    fields3d = [0]*n
-    field_names = [0]*n
-    freq_names = [0]*n
-    freqs = [0]*n
+    fields3d = numpy.empty((n, 3, len(xlines), len(ylines), len(zlines)), dtype=numpy.complex64)  # (field, comp, x, y, z)
+    field_names = []
+    freq_names = []
+    freqs = numpy.empty(n)
     for i, sTreePath in enumerate(efield_names + hfield_names):
         # example:
         # sTreePath = b'2D/3D Results\H-Field\h-field (f=8) [1]'
@@ -142,28 +160,23 @@ def load_fields(CST_version, sProjectPath, sProjectName, freqScale, verbose=Fals
         resSize = ctypes.c_int(-1)
         ret = cstlib.CST_Get3DHexResultSize(ctypes.byref(pHandle), sTreePath, iResultNumber, ctypes.byref(resSize))
         if verbose: print("\n\nRead ", resSize, " floats from ",sTreePath, end=' ')
-        field3d = (ctypes.c_float * (resSize.value))()
-        ret = cstlib.CST_Get3DHexResult(ctypes.byref(pHandle), sTreePath, iResultNumber, ctypes.byref(field3d))
+        buf = (ctypes.c_float * (resSize.value))()
+        ret = cstlib.CST_Get3DHexResult(ctypes.byref(pHandle), sTreePath, iResultNumber, ctypes.byref(buf))
         # 3D-Felder
-        field3d = numpy.array(field3d[0::2]) + 1j*numpy.array(field3d[1::2])
-        x_comp_3d = (field3d[0*Np : 1*Np]).reshape((len(zlines), len(ylines), len(xlines)))
-        x_comp_3d=numpy.swapaxes(x_comp_3d, 0, 2)
-        y_comp_3d = (field3d[1*Np : 2*Np]).reshape((len(zlines), len(ylines), len(xlines)))
-        y_comp_3d=numpy.swapaxes(y_comp_3d, 0, 2)
-        z_comp_3d = (field3d[2*Np : 3*Np]).reshape((len(zlines), len(ylines), len(xlines)))
-        z_comp_3d=numpy.swapaxes(z_comp_3d, 0, 2)
-        fields3d[i] = [x_comp_3d, y_comp_3d, z_comp_3d]
+        # interleaved float32 (re, im) pairs are complex64 in memory -> reinterpret, don't copy
+        field3d = numpy.ctypeslib.as_array(buf).view(numpy.complex64)
+        # components are stored one after the other, x fastest -> one reshape, axes (comp, x, y, z)
+        fields3d[i] = field3d[0 : 3*Np].reshape((3, len(zlines), len(ylines), len(xlines))).transpose(0, 3, 2, 1)
         # Feldname, Frequenz
-        p=re.compile('[H,E]-Field')    
-        field_names[i] = p.findall(str(sTreePath))[0]
-        p=re.compile(r'\(f=[-+]?\d+\.?\d*\)')
-        freq_name = p.findall(str(sTreePath))[0]
-        freq_names[i] = freq_name
+        field_names.append(_FIELD_TYPE_RE.search(sTreePath).group().decode())
+        freq_name = _FREQ_RE.search(sTreePath).group().decode()
+        freq_names.append(freq_name)
         freqs[i] = float(freq_name[3:-1]) * freqScale
+    field_names = numpy.array(field_names)
+    freq_names = numpy.array(freq_names)
     # Close project
     ret = cstlib.CST_CloseProject(ctypes.byref(pHandle))#
     if ret!=0: sys.exit("Close Project Error: "+str(ret))
-    _ctypes.FreeLibrary(cstlib._handle)
     return efield_names, hfield_names, xlines, ylines, zlines, fields3d, field_names, freq_names, freqs
 
 
@@ -172,28 +185,21 @@ def slice_1d(efield_names, hfield_names, xlines, ylines, zlines, fields3d, x0, y
     # x0, y0 in xlines, ylines nachschlagen -> ix, iy
     ix = (numpy.abs(xlines-x0)).argmin()
     x0 = xlines[ix]
-    dx = xlines[ix+1]-xlines[ix]
+    dx = float(xlines[ix+1]-xlines[ix])  # python float keeps the complex64 fields complex64
     iy = (numpy.abs(ylines-y0)).argmin()
     y0 = ylines[iy]
-    dy = ylines[iy+1]-ylines[iy]
-
-    n = len(efield_names + hfield_names)
-    z_comps = [0]*n
-    x_grads = [0]*n
-    y_grads = [0]*n
-    for i, sTreePath in enumerate(efield_names + hfield_names):
-        field3d = fields3d[i]
-
-        # zComp vorbereiten
-        z_comp_3d = field3d[2]
-        z_comp_0 = z_comp_3d[ix, iy, :]
-        z_comp_x = z_comp_3d[ix+1, iy, :]
-        z_comp_y = z_comp_3d[ix, iy+1, :]
-
-        # Ergebnis: 1D-slice
-        z_comps[i] = z_comp_0
-        x_grads[i] = (z_comp_x-z_comp_0) / dx
-        y_grads[i] = (z_comp_y-z_comp_0) / dy
+    dy = float(ylines[iy+1]-ylines[iy])
+
+    # zComp vorbereiten: (ix..ix+1, iy..iy+1)-neighbourhood of all fields, shape (n, 2, 2, nz)
+    z_comp = numpy.asarray(fields3d)[:, 2, ix:ix+2, iy:iy+2, :]  # no copy for the array from load_fields
+    z_comp_0 = z_comp[:, 0, 0, :]
+    z_comp_x = z_comp[:, 1, 0, :]
+    z_comp_y = z_comp[:, 0, 1, :]
+
+    # Ergebnis: 1D-slices, shape (n, nz)
+    z_comps = z_comp_0
+    x_grads = (z_comp_x-z_comp_0) / dx
+    y_grads = (z_comp_y-z_comp_0) / dy
     return z_comps, x_grads, y_grads, x0, y0
 
 
@@ -201,26 +207,32 @@ def save_hd5_3d(hd5path, efield_names, hfield_names, xlines, ylines, zlines, fie
     for i, sTreePath in enumerate(efield_names + hfield_names):
         with h5py.File(os.path.join(hd5path, field_names[i]+' '+freq_names[i]+'.hdf5'),'w') as f:
             print(f)
-            f.create_dataset('Type', data=[numpy.string_(field_names[i])])
+            f.create_dataset('Type', data=[numpy.bytes_(field_names[i])])
             f.create_dataset('f', data=[freqs[i]])
             f.create_dataset('x', data=xlines)
             f.create_dataset('y', data=ylines)
             f.create_dataset('z', data=zlines)
-            f.create_dataset('field3d', data=fields3d[i])
+            # one chunk per component and x-plane: a z-line [comp, ix, iy, :] is read from a single chunk
+            field3d = numpy.ascontiguousarray(fields3d[i])
+            dset = f.create_dataset('field3d', shape=field3d.shape, dtype=field3d.dtype, chunks=(1, 1, len(ylines), len(zlines)),
+                                    compression='gzip', shuffle=True)
+            dset.write_direct(field3d)
 
 
 def save_hd5_1d(hd5path, efield_names, hfield_names, zlines, z_comps, x_grads, y_grads, field_names, freq_names, freqs, x0, y0):  
-    for i, sTreePath in enumerate(efield_names + hfield_names):#f"{(x0/1e-3):.3f}".rstrip('0').rstrip('.')    str(y0/1e-3)
-        with h5py.File(os.path.join(hd5path, field_names[i]+' '+freq_names[i]+' x0='+f"{(x0):.4f}".rstrip('0').rstrip('.')+' y0='+f"{(y0):.4f}".rstrip('0').rstrip('.')+'.hdf5'),'w') as f:
+    sx0 = f"{(x0):.4f}".rstrip('0').rstrip('.')  #f"{(x0/1e-3):.3f}".rstrip('0').rstrip('.')    str(y0/1e-3)
+    sy0 = f"{(y0):.4f}".rstrip('0').rstrip('.')
+    for i, sTreePath in enumerate(efield_names + hfield_names):
+        with h5py.File(os.path.join(hd5path, field_names[i]+' '+freq_names[i]+' x0='+sx0+' y0='+sy0+'.hdf5'),'w') as f:
             print(f)
-            f.create_dataset('Type', data=[numpy.string_(field_names[i])])
+            f.create_dataset('Type', data=[numpy.bytes_(field_names[i])])
             f.create_dataset('f', data=[freqs[i]])
             f.create_dataset('x0', data=[x0])
             f.create_dataset('y0', data=[y0])
             f.create_dataset('z', data=zlines)
-            f.create_dataset('zComp', data=z_comps[i])
-            f.create_dataset('xGrad', data=x_grads[i])
-            f.create_dataset('yGrad', data=y_grads[i])
+            f.create_dataset('zComp', data=z_comps[i], compression='gzip', shuffle=True)
+            f.create_dataset('xGrad', data=x_grads[i], compression='gzip', shuffle=True)
+            f.create_dataset('yGrad', data=y_grads[i], compression='gzip', shuffle=True)
             print(field_names[i], numpy.array(freqs[i]))
 
 
@@ -246,11 +258,47 @@ def project_to_3d_files(sProjectPath, sProjectName, hd5BasePath, freqScale, CST_
     return 0
 
 
-def all_projects_to_3d_files(sProjectPath, freqScale, project_names = [], hd5_folder='hd5', CST_version=2019, force_overwrite=False, verbose=False):
+def _run_project(project_to_files, sProjectPath, sProjectName, args):
+    print("\n\n")
+    print("#####################################")
+    print("####", sProjectName)
+    print("#####################################")
+    t = time.time()
+    retval = project_to_files(sProjectPath, sProjectName, *args)
+    if retval ==1:
+        print('hd5-files already exist!')
+    elapsed = numpy.round(time.time() - t)
+    print('elapsed time: '+str(elapsed))
+
+
+def _run_projects(project_to_files, sProjectPath, project_names, args, max_workers):
+    """
+    Run project_to_files for all projects, in parallel processes if max_workers > 1
+
+    Processes instead of threads, since the dll is not known to be thread-safe and os.chdir is process-global.
+    Each worker process loads the dll once and keeps it for all of its projects.
+    Each worker holds the fields of a whole project in memory, and its output is not shown in Jupyter.
+    On Windows the workers are spawned: the calling script needs an if __name__ == "__main__": guard.
+    """
+    if max_workers <= 1 or len(project_names) <= 1:
+        try:
+            for sProjectName in project_names:
+                _run_project(project_to_files, sProjectPath, sProjectName, args)
+        finally:
+            shutdown()
+        return
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(project_names))) as ex:
+        futures = [ex.submit(_run_project, project_to_files, sProjectPath, sProjectName, args) for sProjectName in project_names]
+        for future in futures:
+            future.result()  # re-raise errors of the workers
+
+
+def all_projects_to_3d_files(sProjectPath, freqScale, project_names = [], hd5_folder='hd5', CST_version=2019, force_overwrite=False, verbose=False, max_workers=1):
+    """
+    3D-export of all .cst projects in sProjectPath (or of project_names), max_workers > 1 runs them in parallel processes (see _run_projects)
+    """
     if not project_names:
-        for file in os.listdir(sProjectPath):
-            if file.endswith(".cst"):
-                project_names.append(file)
+        project_names = [e.name for e in os.scandir(sProjectPath) if e.is_file() and e.name.endswith(".cst")]
         print("\n\n\n########################################################")
         print('3D-export of all projects in folder. Found projects:', project_names)
 
@@ -258,17 +306,8 @@ def all_projects_to_3d_files(sProjectPath, freqScale, project_names = [], hd5_fo
     if not os.path.exists(hd5BasePath):
         os.mkdir(hd5BasePath)
 
-    for sProjectName in project_names:
-        print("\n\n")
-        print("#####################################")
-        print("####", sProjectName)
-        print("#####################################")
-        t = time.time()
-        retval = project_to_3d_files(sProjectPath, sProjectName, hd5BasePath, freqScale, CST_version, force_overwrite, verbose)
-        if retval ==1:
-            print('hd5-files already exist!')
-        elapsed = numpy.round(time.time() - t)
-        print('elapsed time: '+str(elapsed))
+    _run_projects(project_to_3d_files, sProjectPath, project_names, 
+                  (hd5BasePath, freqScale, CST_version, force_overwrite, verbose), max_workers)
 
 
 def project_to_1d_files(sProjectPath, sProjectName, hd5BasePath, x0, y0, freqScale, CST_version=2019, force_overwrite=False, verbose=False):
@@ -294,11 +333,12 @@ def project_to_1d_files(sProjectPath, sProjectName, hd5BasePath, x0, y0, freqSca
     return 0
 
 
-def all_projects_to_1d_files(sProjectPath, x0, y0, freqScale, project_names = [], hd5_folder='hd5', CST_version=2019, force_overwrite=False, verbose=False):
+def all_projects_to_1d_files(sProjectPath, x0, y0, freqScale, project_names = [], hd5_folder='hd5', CST_version=2019, force_overwrite=False, verbose=False, max_workers=1):
+    """
+    1D-export of all .cst projects in sProjectPath (or of project_names), max_workers > 1 runs them in parallel processes (see _run_projects)
+    """
     if not project_names:
-        for file in os.listdir(sProjectPath):
-            if file.endswith(".cst"):
-                project_names.append(file)
+        project_names = [e.name for e in os.scandir(sProjectPath) if e.is_file() and e.name.endswith(".cst")]
         print("\n\n\n########################################################")
         print('1D-export of all projects in Folder. Found projects:', project_names)
 
@@ -306,17 +346,8 @@ def all_projects_to_1d_files(sProjectPath, x0, y0, freqScale, project_names = []
     if not os.path.exists(hd5BasePath):
         os.mkdir(hd5BasePath)
 
-    for sProjectName in project_names:
-        print("\n\n")
-        print("#####################################")
-        print("####", sProjectName)
-        print("#####################################")
-        t = time.time()
-        retval = project_to_1d_files(sProjectPath, sProjectName, hd5BasePath, x0, y0, freqScale, CST_version, force_overwrite, verbose)
-        if retval ==1:
-            print('hd5-files already exist!')
-        elapsed = numpy.round(time.time() - t)
-        print('elapsed time: '+str(elapsed))
+    _run_projects(project_to_1d_files, sProjectPath, project_names, 
+                  (hd5BasePath, x0, y0, freqScale, CST_version, force_overwrite, verbose), max_workers)
 
 
 if __name__ == "__main__":
@@ -8,13 +8,17 @@
 import os
 import numpy as np
 import h5py
-from scipy.integrate import cumtrapz
-from numpy.matlib import repmat
+from scipy.integrate import cumulative_trapezoid
+try:
+    import numba
+except ImportError:  # numba is optional, fall back to plain numpy
+    numba = None
 
 np.seterr(divide='ignore', invalid='ignore')
 clight = 299792458
 m_proton=938.272046e6  # eV/c0**2
 e_over_m_proton=9.580e7  # C/kg
+beam_input_types = ('beta', 'gamma', 'p_over_A', 'Wkin_over_A', 'Brho')  # codes of beam_converter_array
 
 
 def beam_converter(input_type, input_value, z_over_A=0):
@@ -91,25 +95,175 @@ def beam_converter(input_type, input_value, z_over_A=0):
     return beta, gamma, p_over_A, Wkin_over_A, Brho
 
 
-def hd5_import_path(path):
-    """Parses all CST-hd5-files in the given folder."""
+def beam_converter_array(input_type_code, input_value, z_over_A=0.):
+    """Array version of beam_converter, e.g. for parameter sweeps.
+    
+    If numba is available, the computation is jit-compiled. From other 
+    jitted functions, call _beam_converter_array with a 1d float64 array 
+    and a float z_over_A directly.
+    
+    Args:
+        input_type_code: Index of the input type in beam_input_types, 
+            e.g. beam_input_types.index('Brho')
+        input_value: Corresponding values, scalar or array.
+        z_over_A: (#protons - #electrons) / #nucleons
+    
+    Returns:
+        beta, gamma, p_over_A, Wkin_over_A, Brho: float64 arrays of the same 
+            shape as input_value. See beam_converter.
+    
+    Examples:
+        >>> beta, gamma, p_over_A, Wkin_over_A, Brho = beam_converter_array(
+        ...     beam_input_types.index('p_over_A'), np.array([970e6/2, 1e9]), 1/2)
+        >>> print(np.round(beta, 3), np.round(Brho, 3))
+        [0.459 0.729] [3.235 6.67 ]
+    """
+    
+    input_value = np.asarray(input_value, dtype=np.float64)
+    out = _beam_converter_array(int(input_type_code), np.ascontiguousarray(input_value.ravel()), float(z_over_A))
+    return tuple(x.reshape(input_value.shape) for x in out)
+
 
-    f = []
-    dEz_dx = []
-    dEz_dy = []
-    Ez = []
+def _beam_converter_array(input_type_code, input_value, z_over_A):
+    """Core of beam_converter_array for a 1d float64 array and a float z_over_A."""
     
-    for ii, filename in enumerate(os.listdir(path)):
-        f_, z, Ez_, dEz_dx_, dEz_dy_, x0, y0 = h5_import_file(path+filename)
-        f.append(f_)
-        dEz_dx.append(dEz_dx_)
-        dEz_dy.append(dEz_dy_)
-        Ez.append(Ez_)
+    # go backwards
+    if input_type_code == 0:  # beta
+        beta = input_value
+        gamma = (1-beta**2)**(-0.5)
+    elif input_type_code == 1:  # gamma
+        gamma = input_value
+        beta = np.sqrt(1-1/gamma**2)
+    elif input_type_code == 2:  # p_over_A
+        gamma_times_beta = input_value/m_proton
+        beta = 1/np.sqrt(1+1/gamma_times_beta**2)
+        gamma = (1-beta**2)**(-0.5)
+    elif input_type_code == 3:  # Wkin_over_A
+        gamma = input_value/m_proton+1
+        beta = np.sqrt(1-1/gamma**2)
+    elif input_type_code == 4:  # Brho
+        if z_over_A == 0:
+            raise ValueError('Please specify charge to calculate Brho.')
+        gamma_times_beta = input_value * z_over_A * e_over_m_proton / clight
+        beta = 1/np.sqrt(1+1/gamma_times_beta**2)
+        gamma = (1-beta**2)**(-0.5)
+    else:
+        raise ValueError('Unknown input type.')
+    
+    # go forward
+    if input_type_code == 2:
+        p_over_A = input_value
+    else:
+        p_over_A = gamma*beta*m_proton  # eV/c
+    
+    if input_type_code == 3:
+        Wkin_over_A = input_value
+    else:
+        Wkin_over_A = (gamma-1)*m_proton  # eV
+    
+    if input_type_code == 4:
+        Brho = input_value
+    elif z_over_A == 0:
+        Brho = np.zeros_like(beta)
+    else:
+        Brho = gamma*beta/z_over_A/e_over_m_proton*clight  # Tm
+    
+    return beta, gamma, p_over_A, Wkin_over_A, Brho
+
+
+if numba is not None:
+    _beam_converter_array = numba.njit(cache=True, fastmath=True)(_beam_converter_array)
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _phase_cumtrapz_kernel(E, k, z, out):
+        nf, nz = E.shape
+        for i in numba.prange(nf):
+            acc = 0j
+            prev = np.exp(1j*k[i]*z[0]) * E[i, 0]
+            out[i, 0] = 0
+            for j in range(1, nz):
+                cur = np.exp(1j*k[i]*z[j]) * E[i, j]
+                acc += 0.5*(prev+cur)*(z[j]-z[j-1])
+                out[i, j] = acc
+                prev = cur
+
+
+def _phase_cumtrapz(E, k, z):
+    """Cumulative trapezoidal integral of exp(j*k*z)*E along z.
+    
+    With numba, phase, product and running integral are computed in a 
+    single pass, parallel over the frequencies.
+    The result keeps the precision of E, i.e. complex64 fields from 
+    fields.py stay complex64.
+    """
+    dtype = np.result_type(E.dtype, np.complex64)
+    if numba is None:
+        phase = np.exp(1j*k[:, None]*z[None, :]).astype(dtype, copy=False)
+        return cumulative_trapezoid(phase * E, x=z, axis=-1, initial=0).astype(dtype, copy=False)
+    out = np.empty(E.shape, dtype=dtype)
+    _phase_cumtrapz_kernel(np.ascontiguousarray(E, dtype=dtype),
+                           np.ascontiguousarray(k, dtype=np.float64),
+                           np.ascontiguousarray(z, dtype=np.float64), out)
+    return out
+
+
+def _border_window(E, z, z_borders):
+    """Part of E and z needed to integrate between z_borders.
+    
+    Outside of z_borders, E counts as zero, like on the complete z-array. 
+    The window keeps one zeroed point on either side, so the half 
+    trapezoids at the borders are included. E itself is not modified; 
+    only the window is copied, and only if a border lies inside z.
+    
+    Returns:
+        E_w, z_w: Window of E and z.
+        i0: Index of z_w[0] in z.
+    """
+    nz = len(z)
+    i0 = np.searchsorted(z, z_borders[0])
+    i1 = max(np.searchsorted(z, z_borders[1], side='right'), i0)
+    j0 = max(i0-1, 0)
+    j1 = min(i1+1, nz)
+    if j0 == i0 and j1 == i1:
+        return E[:, j0:j1], z[j0:j1], j0
+    E_w = E[:, j0:j1].copy()
+    E_w[:, :i0-j0] = 0
+    E_w[:, max(i1-j0, 0):] = 0
+    return E_w, z[j0:j1], j0
+
+
+def _pad_cumulative(I, i0, nz):
+    """Extend a cumulative integral over z[i0:i0+I.shape[1]] to all nz z-values.
+    
+    It is 0 before and constant after the integration limits.
+    If I already covers all z-values, it is returned as is.
+    """
+    if i0 == 0 and I.shape[1] == nz:
+        return I
+    out = np.empty(I.shape[:-1] + (nz,), dtype=I.dtype)
+    out[:, :i0] = 0
+    out[:, i0:i0+I.shape[1]] = I
+    out[:, i0+I.shape[1]:] = I[:, -1:]
+    return out
+
 
-    f = np.array(f)
-    dEz_dx = np.array(dEz_dx)
-    dEz_dy = np.array(dEz_dy)
-    Ez = np.array(Ez)
+def hd5_import_path(path):
+    """Parses all CST-hd5-files in the given folder."""
+
+    filenames = os.listdir(path)
+    n = len(filenames)
+    f = np.empty(n)
+    
+    for ii, filename in enumerate(filenames):
+        f[ii], z, Ez_, dEz_dx_, dEz_dy_, x0, y0 = h5_import_file(path+filename)
+        if ii == 0:
+            # all files of a folder share the z-mesh -> fill preallocated (len(f), len(z)) arrays
+            Ez = np.empty((n,) + Ez_.shape, dtype=Ez_.dtype)
+            dEz_dx = np.empty((n,) + dEz_dx_.shape, dtype=dEz_dx_.dtype)
+            dEz_dy = np.empty((n,) + dEz_dy_.shape, dtype=dEz_dy_.dtype)
+        Ez[ii] = Ez_
+        dEz_dx[ii] = dEz_dx_
+        dEz_dy[ii] = dEz_dy_
     
     return f, z, Ez, dEz_dx, dEz_dy, x0, y0
     
@@ -118,10 +272,10 @@ def h5_import_file(file_with_path):
     """Parse information from one single CST-hd5-file."""
     
     with h5py.File(file_with_path, 'r') as file:
-        x0 = float(np.array(file['x0']))
-        y0 = float(np.array(file['y0']))
+        x0 = float(file['x0'][0])
+        y0 = float(file['y0'][0])
         z = file['z'][:]
-        f = float(np.array(file['f']))
+        f = float(file['f'][0])
         dEz_dx = file['xGrad'][:]
         dEz_dy = file['yGrad'][:]
         Ez = file['zComp'][:]
@@ -129,6 +283,12 @@ def h5_import_file(file_with_path):
     return f, z, Ez, dEz_dx, dEz_dy, x0, y0
 
 
+def _mat_complex(aa):
+    """Combine the real and imaginary fields of a matlab compound array."""
+    re_name, im_name = aa.dtype.names[:2]
+    return aa[re_name] + 1j*aa[im_name]
+
+
 def matlab_import_file(path):
     """Parses a matlab .mat file.
 	This is a personal function to read my old matlab results.
@@ -141,19 +301,19 @@ def matlab_import_file(path):
         x0 = np.array(file.get("x0"))[0][0]
         aa = np.array(file.get("xGrad"))
         if type(aa[0][0]) == np.void:  # complex numbers are tuples
-            dEz_dx = np.array([[a+1j*b for a,b in line] for line in aa]).transpose()
+            dEz_dx = _mat_complex(aa).transpose()
         else:
             dEz_dx = aa
         y0 = np.array(file.get("y0"))[0][0]
         aa = np.array(file.get("yGrad"))
         if type(aa[0][0]) == np.void:  # complex numbers are tuples
-            dEz_dy = np.array([[a+1j*b for a,b in line] for line in aa]).transpose()
+            dEz_dy = _mat_complex(aa).transpose()
         else:
             dEz_dy = aa
         z = np.array(file.get("z")).transpose()[0]
         aa = np.array(file.get("zComp"))
         if type(aa[0][0]) == np.void:  # complex numbers are tuples
-            Ez = np.array([[a+1j*b for a,b in line] for line in aa]).transpose()
+            Ez = _mat_complex(aa).transpose()
         else:
             Ez = aa
     
@@ -184,9 +344,7 @@ def rotate_phase(A, f, f1, f2):
     phi = np.unwrap(np.angle(A[:,-1]))
     phi1 = phi[i1]
     phi2 = phi[i2]
-    _, nz = A.shape
-    B = repmat(np.exp(-1j*f/(f2-f1)*(phi2-phi1)), nz, 1).transpose()
-    out = A*B
+    out = A * np.exp(-1j*f/(f2-f1)*(phi2-phi1))[:, None]
     phi0 = np.angle(out[i1,-1])
     out *= np.exp(-1j*phi0)
     return out
@@ -214,6 +372,7 @@ def kickerLong(Ez, z, f, Pin_eff, beta, z_borders=[0, 0], Zc=50):
         Pin_eff: Total applied rms-power to all ports. 
         beta: beam velocity, divided by speed of light.
         z_borders: Integration limits. Default is the complete z-array.
+            The field outside is treated as zero; the input array is not modified.
     
     Returns:
         Rshunt: R|T|^2, shunt impedance for the given beta
@@ -241,6 +400,16 @@ def kickerLong(Ez, z, f, Pin_eff, beta, z_borders=[0, 0], Zc=50):
             - T: Transit time factor, i.e. reduction factor of beam voltage due to 
                 finite beam velocity.
                 $$T=\frac{V}{V_0}$$
+    
+    Examples:
+        The field counts as zero outside of z_borders, so the integral 
+        includes the half mesh cells at the borders:
+        
+        >>> z = np.linspace(-1, 1, 41)  # dz = 0.05
+        >>> Ez = np.ones((1, len(z)))
+        >>> Rshunt, K, ZP, V, VK, (V0, R, T) = kickerLong(Ez, z, np.array([1e6]), 1, 1, z_borders=[-0.49, 0.49])
+        >>> print(np.round(V0[:, -1], 3), Ez.min())
+        [0.95] 1.0
             
             
     2015-11-11 Bernd Breitkreutz (Matlab Version)
@@ -262,16 +431,14 @@ def kickerLong(Ez, z, f, Pin_eff, beta, z_borders=[0, 0], Zc=50):
         else:
             raise ValueError('Currently only single betas are supported.')
     
-    Ez[:, z<z_borders[0]] = 0
-    Ez[:, z>z_borders[1]] = 0
+    Ez_w, z_w, i0 = _border_window(Ez, z, z_borders)
     
     k = 2*np.pi*f / (beta*clight)
-    z_ = repmat(z, nf, 1)
-    k_ = repmat(k, nz, 1).transpose()
     
     VK = np.sqrt(2 * Zc * Pin_eff)
-    V0 = cumtrapz(Ez, x=z, initial=0)
-    V = cumtrapz(np.exp(1j*k_*z_) * Ez, x=z, initial=0)
+    V0 = _pad_cumulative(cumulative_trapezoid(Ez_w, x=z_w, axis=-1, initial=0)
+                         .astype(np.result_type(Ez.dtype, np.float32), copy=False), i0, nz)
+    V = _pad_cumulative(_phase_cumtrapz(Ez_w, k, z_w), i0, nz)
     K = V/VK
     Rshunt = Zc*np.abs(K)**2
     R = abs(V0)**2/(2*Pin_eff)
@@ -304,6 +471,7 @@ def kickerTrans(dEz_du, z, f, Pin_eff, beta, z_borders=[0, 0], Zc=50, extra_valu
         Pin_eff: Total applied rms-power to all ports. 
         beta: beam velocity, divided by speed of light.
         z_borders: Integration limits. Default is the complete z-array.
+            The field outside is treated as zero; the input array is not modified.
         extra_values: Will present additional parameters. Not Implemented yet.
     
     Returns:
@@ -358,16 +526,13 @@ def kickerTrans(dEz_du, z, f, Pin_eff, beta, z_borders=[0, 0], Zc=50, extra_valu
         else:
             raise ValueError('Currently only single betas are supported.')
     
-    dEz_du[:, z<z_borders[0]] = 0
-    dEz_du[:, z>z_borders[1]] = 0
+    dEz_du_w, z_w, i0 = _border_window(dEz_du, z, z_borders)
     
     k = 2*np.pi*f / (beta*clight)
-    z_ = repmat(z, nf, 1)
-    k_ = repmat(k, nz, 1).transpose()
-    omg_ = repmat(2*np.pi*f, nz, 1).transpose()
+    omg_ = (2*np.pi*f)[:, None]
     
     VK = np.sqrt(2 * Zc * Pin_eff)
-    dV_over_du = cumtrapz(np.exp(1j*k_*z_) * dEz_du, x=z, initial=0)
+    dV_over_du = _pad_cumulative(_phase_cumtrapz(dEz_du_w, k, z_w), i0, nz)
     Ku = 1j*beta*clight/omg_*1/VK*dV_over_du
     Ru_shunt = Zc*np.abs(Ku)**2
     ZPu_prime = -1j/2*omg_/(beta*clight)*Zc*Ku